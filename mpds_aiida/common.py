@@ -1,6 +1,8 @@
 
 import os
 import json
+from copy import deepcopy
+from functools import lru_cache
 from collections import namedtuple
 
 import yaml
@@ -8,7 +10,6 @@ from ase.data import chemical_symbols
 
 from aiida_crystal_dft.io.d12 import D12
 from aiida_crystal_dft.io.basis import BasisFile # NB only used to determine ecp
-from mpds_client import APIError
 
 from mpds_aiida import TEMPLATE_DIR
 
@@ -55,20 +56,47 @@ def get_basis_sets(repo_dir):
     return bs_repo
 
 
+@lru_cache(maxsize=16)
+def _read_template(template_loc, mtime):
+    """
+    Parses the template once per file modification time;
+    the returned dict is shared, so it must not be mutated
+    """
+    with open(template_loc) as f:
+        return yaml.load(f.read(), Loader=yaml.SafeLoader)
+
+
 def get_template(template='minimal.yml'):
     """
-    Templates present the permanent calc setup
+    Templates present the permanent calc setup,
+    returns a private copy, safe to modify
     """
     template_loc = os.path.join(TEMPLATE_DIR, template)
-    if not os.path.exists(template_loc):
+    try:
+        mtime = os.stat(template_loc).st_mtime_ns
+    except FileNotFoundError:
         template_loc = template
+        mtime = os.stat(template_loc).st_mtime_ns
 
-    assert os.path.exists(template_loc)
-
-    with open(template_loc) as f:
-        calc = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    calc = _read_template(os.path.abspath(template_loc), mtime)
     # assert 'parameters' in calc and 'crystal' in calc['parameters'] and 'basis_family' in calc
-    return calc
+    return deepcopy(calc)
+
+
+def cow_merge(base, overlay):
+    """
+    Recursively merges overlay into base without modifying either,
+    copying only the branches touched by overlay and sharing the rest,
+    returns dict
+    """
+    result = dict(base)
+    for key, value in overlay.items():
+        if isinstance(value, dict):
+            branch = base.get(key)
+            result[key] = cow_merge(branch if isinstance(branch, dict) else {}, value)
+        else:
+            result[key] = value
+    return result
 
 
 def get_input(calc_params_crystal, elements, bs_src, label):
@@ -108,6 +136,8 @@ def get_mpds_structures(mpds_api, elements, more_query_args=None):
     if more_query_args and type(more_query_args) == dict:
         query.update(more_query_args)
 
+    from mpds_client import APIError  # NB not at module level, the workflows should not load it
+
     try:
         for item in mpds_api.get_data(
             query,
@@ -159,6 +189,8 @@ def get_mpds_phases(mpds_api, elements, more_query_args=None):
     if more_query_args and type(more_query_args) == dict:
         query.update(more_query_args)
 
+    from mpds_client import APIError
+
     try:
         for item in mpds_api.get_data(
             query,
@@ -0,0 +1,120 @@
+from copy import deepcopy
+from types import SimpleNamespace
+
+import pytest
+from aiida.common.extendeddicts import AttributeDict
+from aiida_crystal_dft.utils import recursive_update
+
+from mpds_aiida.common import get_template, cow_merge
+from mpds_aiida.workflows.crystal import MPDSCrystalWorkChain, _iterative_update
+
+
+TEMPLATES = ('minimal.yml', 'metallic.yml', 'nonmetallic.yml')
+
+
+def get_batches(calculations, optimization=None, after=None):
+    after = after or {}
+    workchain = SimpleNamespace(ctx=SimpleNamespace(
+        calculations=calculations,
+        optimization=optimization,
+        after_gate={c: (after.get(c), None, None) for c in calculations},
+        running_calc=-1,
+        batch=[]
+    ))
+    batches = []
+    while MPDSCrystalWorkChain.has_calc_to_run(workchain):
+        batches.append(workchain.ctx.batch)
+    return batches
+
+
+def test_optimization_runs_alone():
+    assert get_batches(['optimise', 'phonons', 'elastic_constants'], optimization='optimise') == \
+        [['optimise'], ['phonons', 'elastic_constants']]
+
+
+def test_after_splits_batches():
+    assert get_batches(['optimise', 'phonons', 'elastic_constants', 'properties'],
+                       optimization='optimise', after={'properties': 'phonons'}) == \
+        [['optimise'], ['phonons', 'elastic_constants'], ['properties']]
+
+
+def test_no_optimization():
+    assert get_batches(['phonons', 'elastic_constants']) == [['phonons', 'elastic_constants']]
+    assert get_batches(['phonons', 'elastic_constants'], after={'elastic_constants': 'phonons'}) == \
+        [['phonons'], ['elastic_constants']]
+
+
+@pytest.mark.parametrize('template', ('metallic.yml', 'nonmetallic.yml'))
+def test_cow_merge(template):
+    options = get_template(template)
+    default = options['default']
+    for calc in options['calculations'].values():
+        overlays = [calc['parameters']] + list(calc.get('on_error', {}).values())
+        for overlay in overlays:
+            default_copy, overlay_copy = deepcopy(default), deepcopy(overlay)
+            assert cow_merge(default, overlay) == recursive_update(deepcopy(default), deepcopy(overlay))
+            # neither of the merged dicts is modified
+            assert default == default_copy
+            assert overlay == overlay_copy
+
+
+@pytest.mark.parametrize('template', TEMPLATES)
+def test_iterative_update(template):
+    for other in TEMPLATES:
+        expected = recursive_update(get_template(template), get_template(other))
+        assert _iterative_update(get_template(template), get_template(other)) == expected
+
+
+def get_legacy_workchain(running_calc, popped=()):
+    """ Workchain stub with the context checkpointed by the older versions,
+    the calculations in popped have already been submitted
+    """
+    metadata = {}
+    for c in ('optimise', 'phonons', 'elastic_constants'):
+        metadata[c] = {'label': c, 'resources': {'num_machines': 1},
+                       f'need_{c}': c != 'elastic_constants',
+                       'after': {'calc': None, 'finished_ok': None, 'exit_status': None},
+                       'calc_type': 'crystal', 'optimize_structure': c == 'optimise'}
+    for c in popped:
+        for key in ('label', f'need_{c}', 'after', 'calc_type', 'optimize_structure'):
+            metadata[c].pop(key)
+    ctx = AttributeDict({
+        'calculations': ['optimise', 'phonons', 'elastic_constants'],
+        'metadata': metadata,
+        'inputs': {c: {'crystal': {'scf': {'k_points': [8, 16]}}} for c in metadata},
+        'restart_inputs': {},
+        'restart': AttributeDict({'idx': 0, 'err': None}),
+        'running_calc': running_calc,
+        'running_calc_type': 'crystal' if popped else None,
+        'is_optimization': bool(popped) and popped[-1] == 'optimise',
+    })
+    return SimpleNamespace(ctx=ctx, inputs=SimpleNamespace(metadata={}), report=lambda msg: None)
+
+
+def test_upgrade_legacy_ctx_before_run():
+    workchain = get_legacy_workchain(-1)
+    MPDSCrystalWorkChain._upgrade_legacy_ctx(workchain)
+    ctx = workchain.ctx
+    assert ctx.optimization == 'optimise'
+    assert ctx.need_flags == {'optimise': True, 'phonons': True, 'elastic_constants': False}
+    assert ctx.calc_types == dict.fromkeys(ctx.calculations, 'crystal')
+    assert ctx.after_gate == dict.fromkeys(ctx.calculations, (None, None, None))
+    assert all(set(m) == {'label', 'resources'} for m in ctx.metadata.values())
+    assert 'restart' not in ctx and 'is_optimization' not in ctx
+    batches = []
+    while MPDSCrystalWorkChain.has_calc_to_run(workchain):
+        batches.append(ctx.batch)
+    assert batches == [['optimise'], ['phonons', 'elastic_constants']]
+
+
+@pytest.mark.parametrize('running_calc, popped', [(0, ('optimise', )), (1, ('optimise', 'phonons'))])
+def test_upgrade_legacy_ctx_while_running(running_calc, popped):
+    workchain = get_legacy_workchain(running_calc, popped)
+    MPDSCrystalWorkChain._upgrade_legacy_ctx(workchain)
+    ctx = workchain.ctx
+    # the running calculation is awaited as a batch of one
+    assert ctx.batch == [ctx.calculations[running_calc]]
+    # the optimization is known while it runs, and the later calculations use the optimized structure
+    assert ctx.optimization == 'optimise'
+    assert MPDSCrystalWorkChain.has_calc_to_run(workchain)
+    assert ctx.batch == ctx.calculations[running_calc + 1:]
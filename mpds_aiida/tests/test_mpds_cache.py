@@ -0,0 +1,77 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from mpds_aiida.workflows import mpds
+
+
+@pytest.fixture
+def mpds_requests(monkeypatch, tmp_path):
+    """ Counts the MPDS requests made, the answer being the request number
+    """
+    made = []
+
+    def fake_request(api_key, query):
+        made.append(query)
+        return [[len(made)]]
+
+    monkeypatch.setattr(mpds, '_mpds_request', fake_request)
+    monkeypatch.setattr(mpds, 'MPDS_CACHE_DIR', str(tmp_path / 'cache'))
+    mpds._mpds_fetch_cached.cache_clear()
+    yield made
+    mpds._mpds_fetch_cached.cache_clear()
+
+
+QUERY = mpds.prepare_query({'formulae': 'MgO', 'sgs': 225})
+
+
+@pytest.mark.parametrize('ttl', ['', '0', '-1', 'nan', 'inf', 'one day'])
+def test_cache_off(monkeypatch, mpds_requests, ttl):
+    monkeypatch.setenv('MPDS_CACHE_TTL', ttl)
+    assert mpds._cache_ttl() is None
+    assert mpds._mpds_fetch('key', QUERY) == [[1]]
+    assert mpds._mpds_fetch('key', QUERY) == [[2]]
+
+
+def test_cache_on(monkeypatch, mpds_requests):
+    monkeypatch.setenv('MPDS_CACHE_TTL', '1')
+    assert mpds._cache_ttl() == 86400
+    assert mpds._mpds_fetch('key', QUERY) == [[1]]
+    assert mpds._mpds_fetch('key', QUERY) == [[1]]
+    assert len(mpds_requests) == 1
+
+
+def test_cache_expires_with_time_bucket(monkeypatch, mpds_requests):
+    monkeypatch.setenv('MPDS_CACHE_TTL', '1')
+    now = mpds.time.time()
+    assert mpds._mpds_fetch('key', QUERY) == [[1]]
+    # the next day both the memory and the disk entries are outdated
+    monkeypatch.setattr(mpds, 'time', SimpleNamespace(time=lambda: now + 86400))
+    assert mpds._mpds_fetch('key', QUERY) == [[2]]
+    assert len(mpds_requests) == 2
+
+
+def test_stale_disk_entry_rejected_and_pruned(monkeypatch, mpds_requests):
+    monkeypatch.setenv('MPDS_CACHE_TTL', '1')
+    assert mpds._mpds_fetch('key', QUERY) == [[1]]
+    cache_loc = mpds._disk_cache_loc(dict(QUERY))
+    other_loc = mpds._disk_cache_loc({'formulae': 'NaCl'})
+    with open(other_loc, 'w') as f:
+        f.write('[]')
+    stale = mpds.time.time() - 2 * 86400
+    for loc in (cache_loc, other_loc):
+        os.utime(loc, (stale, stale))
+    mpds._mpds_fetch_cached.cache_clear()
+    # the stale file is not served; the unrelated stale one is pruned on write
+    assert mpds._mpds_fetch('key', QUERY) == [[2]]
+    assert os.path.exists(cache_loc)
+    assert not os.path.exists(other_loc)
+
+
+def test_unwritable_cache_dir(monkeypatch, tmp_path, mpds_requests):
+    monkeypatch.setenv('MPDS_CACHE_TTL', '1')
+    # NB a file in place of a parent folder fails even for root, unlike permissions
+    (tmp_path / 'file').write_text('')
+    monkeypatch.setattr(mpds, 'MPDS_CACHE_DIR', str(tmp_path / 'file' / 'cache'))
+    assert mpds._mpds_fetch('key', QUERY) == [[1]]
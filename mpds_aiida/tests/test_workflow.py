@@ -1,5 +1,7 @@
 
 import os
+import sys
+import subprocess
 # noinspection PyUnresolvedReferences
 from aiida.manage.tests.pytest_fixtures import temp_dir, aiida_localhost, aiida_profile, aiida_local_code_factory
 from mpds_aiida.tests import TEST_DIR
@@ -33,6 +35,30 @@ def test_workchain_run(aiida_localhost, aiida_profile, aiida_local_code_factory,
     assert 'output_bands' in results
 
 
+def test_context_survives_checkpoint(aiida_profile, aiida_local_code_factory, test_basis):
+    from ase.build import bulk
+    from aiida.plugins import DataFactory
+    from aiida.engine.utils import instantiate_process
+    from aiida.manage.manager import get_manager
+    from aiida.orm.utils.serialize import serialize
+    try:
+        from aiida.orm.utils.serialize import deserialize_unsafe as deserialize
+    except ImportError:  # AiiDA 1.x
+        from aiida.orm.utils.serialize import deserialize
+    from mpds_aiida.workflows.aiida import AiidaStructureWorkChain
+    code = aiida_local_code_factory('mock_crystal', str(TEST_DIR / 'mock' / 'crystal'))
+    inputs = {
+        'structure': DataFactory('structure')(ase=bulk('MgO', 'rocksalt', a=4.21)),
+        'workchain_options': {'codes': {'crystal': code.full_label}, 'basis_family': 'STO-3G'},
+    }
+    process = instantiate_process(get_manager().get_runner(), AiidaStructureWorkChain, **inputs)
+    assert process.init_inputs() is None
+    # the whole ctx goes to the YAML checkpoint, so it has to round-trip
+    restored = deserialize(serialize(dict(process.ctx)))
+    assert restored.keys() == process.ctx.keys()
+    assert restored['codes']['crystal'].uuid == code.uuid
+
+
 def test_mpds():
     from mpds_client import MPDSDataRetrieval
     key = os.getenv('MPDS_KEY')
@@ -47,3 +73,11 @@ def test_mpds():
         ]}
     )
     assert len(set(_[0] for _ in answer)) == 1
+
+
+def test_mpds_client_not_loaded_on_import():
+    # NB a fresh interpreter, since other tests may have loaded mpds_client already
+    code = ("import sys; import mpds_aiida.workflows.mpds; "
+            "print(' '.join(m for m in ('mpds_client', 'httplib2') if m in sys.modules))")
+    loaded = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    assert not loaded.strip()
@@ -10,6 +10,9 @@ from metis_backend.structures.cif_utils import cif_to_ase
 from .crystal import MPDSCrystalWorkChain
 
 
+StructureData = get_data_class('structure')
+
+
 class CIFStructureWorkChain(MPDSCrystalWorkChain):
 
     @classmethod
@@ -34,4 +37,5 @@ class CIFStructureWorkChain(MPDSCrystalWorkChain):
         if 'disordered' in ase_obj.info:
             return self.exit_codes.ERROR_DISORDERED_STRUCTURE
 
-        return get_data_class('structure')(ase=ase_obj)
+        self._ase_structure = ase_obj
+        return StructureData(ase=ase_obj)
@@ -1,18 +1,59 @@
 """
 The base workflow for AiiDA combining CRYSTAL and MPDS
 """
+import json
+import hashlib
 from copy import deepcopy
 from abc import abstractmethod
+from functools import lru_cache
 
-from aiida.engine import WorkChain, if_, while_
-from aiida.common.extendeddicts import AttributeDict
+from aiida.engine import WorkChain, if_, while_, submit
 from aiida.engine import ExitCode
-from aiida.orm import Code
+from aiida.common.exceptions import NotExistent, MultipleObjectsError
+from aiida.manage.configuration import get_profile
+from aiida.orm import Code, Data, load_node
 from aiida.orm.nodes.data.base import to_aiida_type
-from aiida_crystal_dft.utils import get_data_class, recursive_update
+from aiida_crystal_dft.utils import get_data_class
 from aiida_crystal_dft.workflows.base import BaseCrystalWorkChain, BasePropertiesWorkChain
 
-from ..common import guess_metal, get_template
+from ..common import guess_metal, get_template, cow_merge
+
+
+Dict = get_data_class('dict')
+BasisFamily = get_data_class('crystal_dft.basis_family')
+
+
+@lru_cache(maxsize=128)
+def _code_uuid(profile_name, label):
+    return Code.get_from_string(label).uuid
+
+
+def _resolve_code(label):
+    """ Loads the code by its label; the label lookup is done once per daemon worker and profile,
+    NB only the UUID is cached, not the node itself
+    """
+    profile_name = get_profile().name
+    try:
+        return load_node(_code_uuid(profile_name, label))
+    except NotExistent:
+        # the code was deleted or set up anew under the same label
+        _code_uuid.cache_clear()
+        return load_node(_code_uuid(profile_name, label))
+
+
+def _iterative_update(dst, src):
+    """ Recursive dict update done with an explicit stack;
+    NB src subtrees missing from dst are attached by reference
+    """
+    stack = [(dst, src)]
+    while stack:
+        d, s = stack.pop()
+        for k, v in s.items():
+            if isinstance(v, dict) and isinstance(d.get(k), dict):
+                stack.append((d[k], v))
+            else:
+                d[k] = v
+    return dst
 
 
 class MPDSCrystalWorkChain(WorkChain):
@@ -25,6 +66,16 @@ class MPDSCrystalWorkChain(WorkChain):
     }
     # options related to this workchain (need_* included!) Other options get sent down the pipe
     OPTIONS_WORKCHAIN = ('optimize_structure', 'recursive_update')
+    # top-level sections a modeling template must have
+    OPTIONS_SECTIONS = frozenset(('codes', 'options', 'basis_family', 'default', 'calculations'))
+    # supported calculation types and the methods running them
+    CALC_RUNNERS = {
+        'crystal': '_run_calc_crystal',
+        'properties': '_run_calc_properties'
+    }
+    # ASE object the geometry was built from, if get_geometry has one at hand;
+    # NB deliberately not in ctx, it is only needed within init_inputs and released there
+    _ase_structure = None
 
     @classmethod
     def define(cls, spec):
@@ -34,11 +85,23 @@ class MPDSCrystalWorkChain(WorkChain):
         # if input is not given, it is taken from the default location
         # it is possible to give incomplete parameters, they will be completed with defaults
         spec.input('workchain_options',
-                   valid_type=get_data_class('dict'),
+                   valid_type=Dict,
                    required=False,
-                   default=lambda: get_data_class('dict')(dict={}),
                    help="Calculation options",
                    serializer=to_aiida_type)
+        # the same options kept out of the provenance graph (saves a node per submission);
+        # they are still recoverable from the inputs of the resulting calculations
+        spec.input('workchain_options_non_db',
+                   valid_type=dict,
+                   required=False,
+                   non_db=True,
+                   help="Calculation options not stored in the database; cannot be given together with workchain_options")
+        spec.input('packed_scheduler',
+                   valid_type=get_data_class('str'),
+                   required=False,
+                   help="Computer with a task-farming scheduler (e.g. HyperQueue) packing all the runs "
+                        "of this workchain into one allocation; the codes are taken by the same labels on it",
+                   serializer=to_aiida_type)
         spec.input('check_for_bond_type',
                    valid_type=get_data_class('bool'),
                    required=False,
@@ -58,16 +121,39 @@ class MPDSCrystalWorkChain(WorkChain):
         # define outputs
         spec.expose_outputs(BaseCrystalWorkChain, exclude=('output_parameters', ))
         spec.expose_outputs(BasePropertiesWorkChain)
-        spec.output_namespace('output_parameters', valid_type=get_data_class('dict'), required=False, dynamic=True)
+        spec.output_namespace('output_parameters', valid_type=Dict, required=False, dynamic=True)
         spec.exit_code(410, 'INPUT_ERROR', 'Error in input')
         spec.exit_code(411, 'ERROR_INVALID_CODE', 'Non-existent code is given')
         spec.exit_code(412, 'ERROR_OPTIMIZATION_FAILED', 'Structure optimization failed!')
 
+    @classmethod
+    def submit_many(cls, inputs_list, **shared_inputs):
+        """ Submits a workchain for each of the given inputs dicts;
+        the shared inputs given as plain python values (e.g. workchain_options dict) are serialized
+        into a node once and linked to all of them, instead of creating an identical node per submission;
+        the values in the inputs dicts take precedence over the shared ones
+        """
+        spec_inputs = cls.spec().inputs
+        shared = {}
+        for key, value in shared_inputs.items():
+            # NB non_db ports and namespaces have no serializer and are passed as is
+            serializer = getattr(spec_inputs.get(key), 'serializer', None)
+            if serializer is not None and not isinstance(value, Data):
+                value = serializer(value)
+            if isinstance(value, Data) and not value.is_stored:
+                value.store()
+            shared[key] = value
+        return [submit(cls, **{**shared, **inputs}) for inputs in inputs_list]
+
     def init_inputs(self):
+        # the options come from one input only; NB checked before getting the structure (may cost an MPDS request)
+        if 'workchain_options_non_db' in self.inputs and 'workchain_options' in self.inputs:
+            self.report('Only one of workchain_options and workchain_options_non_db can be given!')
+            return self.exit_codes.INPUT_ERROR
+
         # check that we actually have the parameters, populate with the defaults if not
 
         # 1) get the structure (label in metadata.label!)
-        self.ctx.codes = AttributeDict()
         self.ctx.structure = self.get_geometry()
 
         if isinstance(self.ctx.structure, ExitCode):  # FIXME
@@ -79,34 +165,58 @@ class MPDSCrystalWorkChain(WorkChain):
             self.report(f"Using {default_file} as modeling template")
         else:
             # check for the bonding type
-            is_metallic = guess_metal(self.ctx.structure.get_ase())
+            ase_structure = self._ase_structure
+            if ase_structure is None:
+                ase_structure = self.ctx.structure.get_ase()
+            is_metallic = guess_metal(ase_structure)
             if is_metallic:
                 default_file = self.OPTIONS_FILES['metallic']
                 self.report(f"Guessed metallic bonding; using {default_file} as modeling template")
             else:
                 default_file = self.OPTIONS_FILES['nonmetallic']
                 self.report(f"Guessed nonmetallic bonding; using {default_file} as modeling template")
+        # the ASE object is not needed anymore, do not keep it for the lifetime of the workchain
+        self._ase_structure = None
         options = get_template(default_file)
 
         # update with workchain options, if present (recursively if needed)
-        changed_options = self.inputs.workchain_options.get_dict()
+        if 'workchain_options_non_db' in self.inputs:
+            changed_options = deepcopy(self.inputs.workchain_options_non_db)
+        elif 'workchain_options' in self.inputs:
+            changed_options = self.inputs.workchain_options.get_dict()
+        else:
+            changed_options = {}
         needs_recursive_update = changed_options.get('options', {}).get('recursive_update',
                                                                 options['options'].get('recursive_update', True))
         if changed_options:
-            if needs_recursive_update:
-                recursive_update(options, changed_options)
+            # NB a plain update is equivalent for the flat overrides
+            if needs_recursive_update and any(isinstance(v, dict) for v in changed_options.values()):
+                _iterative_update(options, changed_options)
             else:
                 options.update(changed_options)
-        self.validate_inputs(options)
+        validation_error = self.validate_inputs(options)
+        if validation_error:
+            return validation_error
 
         # put options to context
-        self.ctx.codes.update({k: Code.get_from_string(v) for k, v in options['codes'].items()})
+        codes = options['codes']
+        if 'packed_scheduler' in self.inputs:
+            computer = self.inputs.packed_scheduler.value
+            codes = {k: v.split('@')[0] + '@' + computer for k, v in codes.items()}
+            self.report(f"Packing calculations at {computer}")
+        try:
+            self.ctx.codes = {k: _resolve_code(v) for k, v in codes.items()}
+        except (NotExistent, MultipleObjectsError) as ex:
+            self.report(f'Cannot load the code: {ex}')
+            return self.exit_codes.ERROR_INVALID_CODE
         self.ctx.basis_family = options['basis_family']
 
         # dealing with calculations (making it priority queue)
-        calculations = dict(zip(options['calculations'].keys(), [10 * i for i in range(len(options['calculations']))]))
-        if 'optimize_structure' in options['options']:
-            optimization = options['options']['optimize_structure']
+        calc_options = options['calculations']
+        wf_options = options['options']
+        optimization = wf_options.get('optimize_structure')
+        calculations = dict(zip(calc_options.keys(), [10 * i for i in range(len(calc_options))]))
+        if optimization is not None:
             if optimization not in calculations:
                 self.report('Optimization procedure not in calculations list!')
                 return self.exit_codes.INPUT_ERROR
@@ -115,60 +225,125 @@ class MPDSCrystalWorkChain(WorkChain):
 
         # deal with after tag
         for c in calculations:
-            after = options['calculations'][c]['metadata'].get('after', None)
+            after = calc_options[c]['metadata'].get('after', None)
             if after is not None:
                 calculations[c] = calculations[after] + 1
         self.ctx.calculations = sorted(calculations, key=calculations.get)
 
+        if any(len(calc_options[c]['parameters']) != 1 for c in calculations):
+            self.report('Calculations must have a definite type!')
+            return self.exit_codes.INPUT_ERROR
+
         # Pre calc stuff
-        self.ctx.metadata = AttributeDict()
-        self.ctx.inputs = AttributeDict()
-        self.ctx.restart_inputs = AttributeDict()
-        self.ctx.restart = AttributeDict({'idx': 0,      # restart sequence number
-                                          'err': None})  # error number defining the next input
+        self.ctx.metadata = {}
+        self.ctx.default_inputs = options['default']
+        self.ctx.inputs = {}
+        self.ctx.restart_inputs = {}
+        self.ctx.after_gate = {}
+        self.ctx.calc_types = {}
+        self.ctx.need_flags = {}
+        self.ctx.dict_nodes = {}
+        # the options sent down the pipe are the same for all calculations but the label
+        need_keys = frozenset(k for k in wf_options if k.startswith('need_'))
+        base_metadata = {k: v for k, v in wf_options.items()
+                         if k not in need_keys and k not in self.OPTIONS_WORKCHAIN}
+        # specially for yascheduler users
+        if 'resources' not in base_metadata:
+            base_metadata['resources'] = {'num_machines': 1, 'num_mpiprocs_per_machine': 2}
+
         for c in calculations:
-            c_metadata = {k: deepcopy(v) for k, v in options['options'].items()
-                          if ('need_' not in k or c in k) and (k not in self.OPTIONS_WORKCHAIN)}
-
-            # add label, calculation type, resources if not given
-            c_metadata['label'] = options['calculations'][c]['metadata']['label']
-            c_metadata['after'] = {"calc": options['calculations'][c]['metadata'].get('after', None),
-                                   "finished_ok": options['calculations'][c]['metadata'].get('finished_ok', None),
-                                   "exit_status": options['calculations'][c]['metadata'].get('exit_status', None)}
-
-            # specially for yascheduler users
-            if 'resources' not in c_metadata:
-                c_metadata['resources'] = {'num_machines': 1, 'num_mpiprocs_per_machine': 2}
-            if any([len(options['calculations'][c]['parameters'].keys()) != 1 for c in calculations]):
-                self.report('Calculations must have a definite type!')
+            calc_opt = calc_options[c]
+            calc_meta = calc_opt['metadata']
+            params = calc_opt['parameters']
+
+            c_metadata = deepcopy(base_metadata)
+            self.ctx.need_flags[c] = wf_options.get('need_' + c, True)
+
+            # add label, calculation type
+            c_metadata['label'] = calc_meta['label']
+            # (after calc, required finished_ok state, required exit status)
+            self.ctx.after_gate[c] = (calc_meta.get('after', None),
+                                      calc_meta.get('finished_ok', None),
+                                      calc_meta.get('exit_status', None))
+
+            calc_type = next(iter(params))
+            if calc_type not in self.CALC_RUNNERS:
+                self.report(f"{c}: Unsupported calculation type {calc_type} in input; exiting!")
                 return self.exit_codes.INPUT_ERROR
-            c_metadata['calc_type'] = list(options['calculations'][c]['parameters'].keys())[0]
-            if 'optimize_structure' in options['options']:
-                c_metadata['optimize_structure'] = (options['options']['optimize_structure'] == c)
-            else:
-                c_metadata['optimize_structure'] = None
+            self.ctx.calc_types[c] = calc_type
+
+            # only the overrides of the default inputs are kept, merged right before submission
             self.ctx.metadata[c] = c_metadata
-            c_input = deepcopy(options['default'])
-            recursive_update(c_input, options['calculations'][c]['parameters'])
-            self.ctx.inputs[c] = c_input
+            self.ctx.inputs[c] = params
 
             # store the inputs that are run on error if there are any
-            if 'on_error' in options['calculations'][c]:
-                for err, err_input in options['calculations'][c]['on_error'].items():
-                    c_err_input = deepcopy(c_input)
-                    recursive_update(c_err_input, err_input)
-                    if c not in self.ctx.restart_inputs:
-                        self.ctx.restart_inputs[c] = {}
-                    self.ctx.restart_inputs[c][err] = c_err_input
+            if 'on_error' in calc_opt:
+                self.ctx.restart_inputs[c] = calc_opt['on_error']
 
+        self.ctx.optimization = optimization
         self.ctx.running_calc = -1
-        self.ctx.running_calc_type = None
-        self.ctx.is_optimization = False
+        self.ctx.batch = []
+        self.ctx.workchain_label = self.inputs.metadata.get('label', 'MPDS CRYSTAL workchain')
+        self.ctx.workchain_description = self.inputs.metadata.get('description', '')
+
+        # the structure goes to ctx; it has to be stored to survive a checkpoint
+        if not self.ctx.structure.is_stored:
+            self.ctx.structure.store()
+
+    def load_instance_state(self, saved_state, load_context):
+        super(MPDSCrystalWorkChain, self).load_instance_state(saved_state, load_context)
+        if 'calculations' in self.ctx and 'after_gate' not in self.ctx:
+            self._upgrade_legacy_ctx()
+
+    def _upgrade_legacy_ctx(self):
+        """ Converts the context checkpointed by the older versions of this workchain,
+        so that the workchains running at upgrade time can be continued;
+        in the old layout ctx.metadata holds the per-calculation flags, which are popped once used,
+        ctx.inputs and ctx.restart_inputs hold the fully merged inputs,
+        and ctx.running_calc points at the calculation being run
+        """
+        ctx = self.ctx
+        self.report('Upgrading the workchain context from the older version')
+        current = ctx.calculations[ctx.running_calc] if 0 <= ctx.running_calc < len(ctx.calculations) else None
+        ctx.need_flags, ctx.after_gate, ctx.calc_types = {}, {}, {}
+        optimize_flags = {}
+        for c in ctx.calculations:
+            c_metadata = ctx.metadata[c]
+            ctx.need_flags[c] = c_metadata.pop(f'need_{c}', True)
+            for key in [k for k in c_metadata if k.startswith('need_')]:
+                del c_metadata[key]
+            after = c_metadata.pop('after', None) or {}
+            ctx.after_gate[c] = (after.get('calc'), after.get('finished_ok'), after.get('exit_status'))
+            ctx.calc_types[c] = c_metadata.pop('calc_type', None) or (
+                ctx.get('running_calc_type') if c == current else None) or 'crystal'
+            if 'optimize_structure' in c_metadata:
+                optimize_flags[c] = c_metadata.pop('optimize_structure')
+
+        # NB only the current and the upcoming calculations need to know the optimization
+        optimization = next((c for c, flag in optimize_flags.items() if flag), None)
+        if optimization is None and ctx.get('is_optimization'):
+            optimization = current
+        if optimization is None and any(flag is False for flag in optimize_flags.values()):
+            # the optimization has already run; any of the calculations run before will do
+            optimization = next((c for c in ctx.calculations[:ctx.running_calc] if c not in optimize_flags),
+                                ctx.calculations[0])
+        ctx.optimization = optimization
+
+        # the inputs are already merged with the defaults
+        ctx.default_inputs = {}
+        ctx.batch = [current] if current is not None else []
+        ctx.dict_nodes = {}
+        ctx.workchain_label = self.inputs.metadata.get('label', 'MPDS CRYSTAL workchain')
+        ctx.workchain_description = self.inputs.metadata.get('description', '')
+        for key in ('restart', 'running_calc_type', 'is_optimization'):
+            ctx.pop(key, None)
 
     def validate_inputs(self, options):
-        valid_keys = ('codes', 'options', 'basis_family', 'default', 'calculations')
-        if set(options.keys()) != set(valid_keys):
-            self.report('Input validation failed!')
+        missing = self.OPTIONS_SECTIONS - options.keys()
+        unknown = options.keys() - self.OPTIONS_SECTIONS
+        if missing or unknown:
+            self.report(f'Input validation failed! Missing sections: {sorted(missing)}, '
+                        f'unknown sections: {sorted(unknown)}')
             return self.exit_codes.INPUT_ERROR
 
     @abstractmethod
@@ -176,31 +351,43 @@ class MPDSCrystalWorkChain(WorkChain):
         raise NotImplemented
 
     def has_calc_to_run(self):
-        self.ctx.running_calc += 1
-        if self.ctx.running_calc == len(self.ctx.calculations):
-            return False
-        return True
+        """ Collects the next batch of calculations to be run concurrently:
+        the structure optimization runs alone, and a calculation never shares a batch
+        with the one given in its after tag
+        """
+        ctx = self.ctx
+        batch = []
+        while ctx.running_calc + 1 < len(ctx.calculations):
+            calculation = ctx.calculations[ctx.running_calc + 1]
+            if batch and (ctx.optimization in (calculation, batch[0]) or ctx.after_gate[calculation][0] in batch):
+                break
+            batch.append(calculation)
+            ctx.running_calc += 1
+        ctx.batch = batch
+        return bool(batch)
 
     def is_needed(self):
-        calculation = self.ctx.calculations[self.ctx.running_calc]
-        is_calc_needed = True
-        if f'need_{calculation}' in self.ctx.metadata[calculation]:
-            is_calc_needed = self.ctx.metadata[calculation].pop(f'need_{calculation}')
+        self.ctx.batch = [calculation for calculation in self.ctx.batch if self._is_calc_needed(calculation)]
+        return bool(self.ctx.batch)
+
+    def _is_calc_needed(self, calculation):
+        ctx = self.ctx
+        is_calc_needed = ctx.need_flags[calculation]
         if not is_calc_needed:
             self.report(f'Calculation {calculation} is not needed due to need_* flag; skipping')
         # check after tag
-        after = self.ctx.metadata[calculation].pop('after')
-        if after['finished_ok'] is not None:
-            calc = self.ctx.get(after['calc'])
+        after_calc, after_finished_ok, after_exit_status = ctx.after_gate[calculation]
+        if after_finished_ok is not None:
+            calc = ctx.get(after_calc)
             ok_finish = calc.is_finished_ok
-            if after['finished_ok'] and ok_finish:
-                self.report(f"Calculation {after['calc']} is finished ok, starting {calculation}")
+            if after_finished_ok and ok_finish:
+                self.report(f"Calculation {after_calc} is finished ok, starting {calculation}")
                 return True
-            if not after['finished_ok']:
+            if not after_finished_ok:
                 # checking exit_status
                 exit_status = calc.called[-1].exit_status
-                if after['exit_status'] is not None and exit_status == after['exit_status']:
-                    self.report(f"Calculation {after['calc']} finished with exit status {exit_status}, "
+                if after_exit_status is not None and exit_status == after_exit_status:
+                    self.report(f"Calculation {after_calc} finished with exit status {exit_status}, "
                                 f"starting {calculation}")
                     return True
             # in any other case calculation is not needed
@@ -220,82 +407,84 @@ class MPDSCrystalWorkChain(WorkChain):
     #     return result
 
     def run_calc(self):
-        calculation = self.ctx.calculations[self.ctx.running_calc]
-        calc_type = self.ctx.metadata[calculation].pop('calc_type')
-        if calc_type not in ('crystal', 'properties'):
-            self.report(f'{calculation}: Unsupported calculation type {calc_type} in input; exiting!')
-            return self.exit_codes.INPUT_ERROR
-        self.ctx.running_calc_type = calc_type
-        return self._run_calc_crystal() if calc_type == 'crystal' else self._run_calc_properties()
-
-    def _run_calc_crystal(self):
-        calculation = self.ctx.calculations[self.ctx.running_calc]
+        ctx = self.ctx
+        running = {}
+        for calculation in ctx.batch:
+            # calculation types are validated in init_inputs
+            result = getattr(self, self.CALC_RUNNERS[ctx.calc_types[calculation]])(calculation)
+            if isinstance(result, ExitCode):
+                return result
+            running[calculation] = result
+        # the whole batch is awaited at once
+        return self.to_context(**running)
+
+    def _run_calc_crystal(self, calculation):
+        ctx = self.ctx
         inputs = BaseCrystalWorkChain.get_builder()
-        if 'crystal' not in self.ctx.codes:
+        if 'crystal' not in ctx.codes:
             self.report('CRYSTAL code not given as input; exiting!')
             return self.exit_codes.ERROR_INVALID_CODE
-        inputs.code = self.ctx.codes['crystal']
-        metadata = self.ctx.metadata[calculation]
-        # metadata.pop('after')
-        optimization = metadata.pop('optimize_structure')
-        self.ctx.is_optimization = optimization
-        if optimization is None or optimization:
+        inputs.code = ctx.codes['crystal']
+        metadata = ctx.metadata[calculation]
+        if ctx.optimization is None or ctx.optimization == calculation:
             self.report(f'{calculation}: Using structure from input')
-            inputs.structure = self.ctx.structure
+            inputs.structure = ctx.structure
         else:
             self.report(f'{calculation}: Using optimized structure')
-            inputs.structure = self.ctx.optimized_structure
-        inputs.basis_family, _ = get_data_class('crystal_dft.basis_family').get_or_create(self.ctx.basis_family)
-        inputs.parameters = get_data_class('dict')(dict=self.ctx.inputs[calculation]['crystal'])
+            inputs.structure = ctx.optimized_structure
+        inputs.basis_family, _ = BasisFamily.get_or_create(ctx.basis_family)
+        # NB the merged inputs share unmodified branches and must not be mutated
+        c_input = cow_merge(ctx.default_inputs, ctx.inputs[calculation])
+        inputs.parameters = self._get_dict_node(c_input['crystal'])
         # delegate restart to child workchain
-        if calculation in self.ctx.restart_inputs:
-            inputs.restart_params = get_data_class('dict')(dict={str(k): v['crystal'] for k, v
-                                                                 in self.ctx.restart_inputs[calculation].items()})
-        workchain_label = self.inputs.metadata.get('label', 'MPDS CRYSTAL workchain')
+        if calculation in ctx.restart_inputs:
+            inputs.restart_params = self._get_dict_node({str(k): cow_merge(c_input, v)['crystal'] for k, v
+                                                         in ctx.restart_inputs[calculation].items()})
         calc_label = metadata.pop('label') if 'label' in metadata else calculation
 
-        if 'oxidation_states' in self.ctx:
-            self.report(f"{calculation}: Using oxidation states {self.ctx.oxidation_states} in {calculation}")
-            metadata["use_oxidation_states"] = self.ctx.oxidation_states
-        inputs.options = get_data_class('dict')(dict=metadata)
+        if 'oxidation_states' in ctx:
+            self.report(f"{calculation}: Using oxidation states {ctx.oxidation_states} in {calculation}")
+            metadata["use_oxidation_states"] = ctx.oxidation_states
+        inputs.options = self._get_dict_node(metadata)
+        # NB label and description are kept out of the hashed options, so the CRYSTAL runs can be cached
         inputs.metadata = {
-            'label': f"{workchain_label}: {calc_label}",
-            'description': self.inputs.metadata.get('description', '')
+            'label': f"{ctx.workchain_label}: {calc_label}",
+            'description': ctx.workchain_description,
+            'call_link_label': calculation
         }
         # noinspection PyTypeChecker
-        crystal_run = self.submit(BaseCrystalWorkChain, **inputs)
-        return self.to_context(**{calculation: crystal_run})
-
-    def _run_calc_properties(self):
+        return self.submit(BaseCrystalWorkChain, **inputs)
+
+    def _get_dict_node(self, content):
+        """ Returns a stored Dict node with the given content,
+        reusing the one already created by this workchain if the content is identical
+        """
+        key = hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+        node = self.ctx.dict_nodes.get(key)
+        if node is None:
+            node = Dict(dict=content).store()
+            self.ctx.dict_nodes[key] = node
+        return node
+
+    def _run_calc_properties(self, calculation):
         raise NotImplemented
 
     def check_and_get_results(self):
-        calculation = self.ctx.calculations[self.ctx.running_calc]
-        calc = self.ctx.get(calculation)
-        ok_finish = calc.is_finished_ok
-
-        # check if this was optimization
-        is_optimization = self.ctx.is_optimization
-        if is_optimization:
-            if not ok_finish:
-                return self.exit_codes.ERROR_OPTIMIZATION_FAILED
-            self.out_many(self.exposed_outputs(calc, BaseCrystalWorkChain))
-            self.ctx.optimized_structure = calc.outputs.output_structure
-        if ok_finish:
-            self.out(f'output_parameters.{calculation}', calc.outputs.output_parameters)
-        else:
-            self.report(f'{calculation} has failed, no outputs are exposed')
-
-    # @staticmethod
-    # def correctly_finalized(calc_string):
-    #     def wrapped(self):
-    #         assert calc_string in self.CALC_STRINGS
-    #         if not hasattr(self.ctx, calc_string):
-    #             return False
-    #         calc = self.ctx.get(calc_string)
-    #         return calc.is_finished_ok
-    #
-    #     return wrapped
+        ctx = self.ctx
+        for calculation in ctx.batch:
+            calc = ctx.get(calculation)
+            ok_finish = calc.is_finished_ok
+
+            # check if this was optimization
+            if calculation == ctx.optimization:
+                if not ok_finish:
+                    return self.exit_codes.ERROR_OPTIMIZATION_FAILED
+                self.out_many(self.exposed_outputs(calc, BaseCrystalWorkChain))
+                ctx.optimized_structure = calc.outputs.output_structure
+            if ok_finish:
+                self.out(f'output_parameters.{calculation}', calc.outputs.output_parameters)
+            else:
+                self.report(f'{calculation} has failed, no outputs are exposed')
 
     # def run_properties_calc(self):
     #     self.ctx.inputs.properties.wavefunction = self.ctx.optimise.outputs.output_wavefunction
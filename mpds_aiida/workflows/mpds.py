@@ -3,17 +3,175 @@
 The MPDS workflow for AiiDA that gets structure with MPDS query
 """
 import os
+import json
+import math
 import time
+import logging
 import random
+import hashlib
+import tempfile
+from functools import lru_cache
 
 import numpy as np
-from httplib2 import ServerNotFoundError
-
 from aiida_crystal_dft.utils import get_data_class
-from mpds_client import MPDSDataRetrieval, APIError
 from .crystal import MPDSCrystalWorkChain
 
 
+StructureData = get_data_class('structure')
+logger = logging.getLogger(__name__)
+
+# backoff on too many parallel MPDS requests (HTTP 429)
+MPDS_MAX_RETRIES = 8
+MPDS_RETRY_BASE = 1   # seconds
+MPDS_RETRY_CAP = 60   # seconds
+# caches of the raw answers, both off unless MPDS_CACHE_TTL (days) is set:
+# in memory, per daemon worker, and on disk, shared by the daemon workers
+MPDS_CACHE_SIZE = 256  # answers kept in memory
+MPDS_CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'mpds_aiida')
+
+MPDS_FIELDS = {'S': [
+    'cell_abc',
+    'sg_n',
+    'basis_noneq',
+    'els_noneq'
+]}
+
+
+def prepare_query(query_dict):
+    """ Restricts the MPDS query to the ordered crystalline structures,
+    returns a hashable (frozen) query
+    """
+    query_dict = dict(query_dict)
+    query_dict['props'] = 'atomic structure'
+    if 'classes' in query_dict:
+        query_dict['classes'] += ', non-disordered'
+    else:
+        query_dict['classes'] = 'non-disordered'
+    return frozenset(query_dict.items())
+
+
+def _cache_ttl():
+    """ Lifetime of the cached answers in seconds, or None if caching is off
+    (MPDS_CACHE_TTL unset, not positive or invalid)
+    """
+    value = os.getenv('MPDS_CACHE_TTL')
+    if not value:
+        return None
+    try:
+        ttl = float(value) * 86400
+    except ValueError:
+        logger.warning(f'Ignoring invalid MPDS_CACHE_TTL={value!r}, the MPDS answers are not cached')
+        return None
+    return ttl if 0 < ttl and math.isfinite(ttl) else None
+
+
+def _disk_cache_loc(query):
+    """ Location of the cached answer for the query
+    """
+    key = hashlib.sha1(json.dumps({'q': query, 'f': MPDS_FIELDS}, sort_keys=True).encode()).hexdigest()
+    return os.path.join(MPDS_CACHE_DIR, key + '.json')
+
+
+def _read_disk_cache(cache_loc, not_before):
+    try:
+        if os.stat(cache_loc).st_mtime < not_before:
+            return None
+        with open(cache_loc) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_disk_cache(cache_loc, answer):
+    # NB written to a temporary file and renamed, so that parallel workers never read it half-done;
+    # the cache is best effort, failing to write it must not fail the workchain
+    tmp_loc = None
+    try:
+        os.makedirs(MPDS_CACHE_DIR, exist_ok=True)
+        fd, tmp_loc = tempfile.mkstemp(dir=MPDS_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(answer, f)
+        os.replace(tmp_loc, cache_loc)
+    except (OSError, TypeError, ValueError):
+        if tmp_loc is not None and os.path.exists(tmp_loc):
+            os.unlink(tmp_loc)
+
+
+def _prune_disk_cache(not_before):
+    """ Removes the cached answers (and leftover temporary files) written before the given time
+    """
+    try:
+        entries = list(os.scandir(MPDS_CACHE_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.name.endswith(('.json', '.tmp')) and entry.stat().st_mtime < not_before:
+                os.unlink(entry.path)
+        except OSError:
+            pass  # removed by a parallel worker
+
+
+@lru_cache(maxsize=None)
+def _mpds_client(api_key):
+    """ One MPDS client per API key and process, shared by all the requests and retries
+    """
+    from mpds_client import MPDSDataRetrieval
+    return MPDSDataRetrieval(api_key=api_key)
+
+
+def _mpds_request(api_key, query):
+    return _mpds_client(api_key).get_data(query, fields=MPDS_FIELDS)
+
+
+@lru_cache(maxsize=MPDS_CACHE_SIZE)
+def _mpds_fetch_cached(api_key, frozen_query, ttl, time_bucket):
+    """ Process-wide cache of the MPDS answers, backed by the disk;
+    all the entries expire at the end of the current ttl-long time bucket,
+    NB the buckets are aligned to the epoch, so they are the same for all the workers
+    """
+    query = dict(frozen_query)
+    cache_loc = _disk_cache_loc(query)
+    not_before = time_bucket * ttl
+    answer = _read_disk_cache(cache_loc, not_before)
+    if answer is None:
+        answer = _mpds_request(api_key, query)
+        _write_disk_cache(cache_loc, answer)
+        # NB expired answers are otherwise only overwritten if the same query comes again
+        _prune_disk_cache(not_before)
+    return answer
+
+
+def _mpds_fetch(api_key, frozen_query):
+    """ Gets the MPDS answer, from the caches if MPDS_CACHE_TTL is set;
+    NB the returned list may be shared and must not be mutated;
+    each answer may weigh megabytes, hence the bounded cache size
+    """
+    ttl = _cache_ttl()
+    if ttl is None:
+        return _mpds_request(api_key, dict(frozen_query))
+    return _mpds_fetch_cached(api_key, frozen_query, ttl, int(time.time() // ttl))
+
+
+def _fetch_with_retry(api_key, frozen_query, log=logger):
+    """ Gets the MPDS answer, retrying the throttled (HTTP 429) requests;
+    other API errors, as well as the last throttled request, are raised
+    """
+    from mpds_client import APIError
+    delay = MPDS_RETRY_BASE
+    for attempt in range(MPDS_MAX_RETRIES):
+        try:
+            return _mpds_fetch(api_key, frozen_query)
+        except APIError as ex:
+            # no point in waiting after the last attempt
+            if ex.code != 429 or attempt == MPDS_MAX_RETRIES - 1:
+                raise
+            # decorrelated jitter, so that the parallel workchains do not retry in lockstep
+            delay = min(MPDS_RETRY_CAP, random.uniform(MPDS_RETRY_BASE, delay * 3))
+            log.warning(f"Too many parallel MPDS requests, chilling for {delay:.1f} s")
+            time.sleep(delay)
+
+
 class MPDSStructureWorkChain(MPDSCrystalWorkChain):
 
     @classmethod
@@ -29,54 +187,77 @@ class MPDSStructureWorkChain(MPDSCrystalWorkChain):
         spec.exit_code(503, 'ERROR_NO_HITS', message='Request returned nothing')
         spec.exit_code(504, 'ERROR_SERVER_NOT_FOUND', message='MPDS server not found')
 
+    @classmethod
+    def prefetch(cls, queries, api_key=None):
+        """ Warms up the MPDS answers caches with the given queries, issuing one request per unique query;
+        NB does nothing unless the caching is on (MPDS_CACHE_TTL)
+        """
+        from mpds_client import APIError
+
+        if _cache_ttl() is None:
+            logger.warning('MPDS answers are not cached (MPDS_CACHE_TTL), skipping prefetch')
+            return
+        api_key = api_key or os.getenv('MPDS_KEY')
+        for frozen_query in set(prepare_query(query) for query in queries):
+            try:
+                _fetch_with_retry(api_key, frozen_query)
+            except APIError as ex:
+                # no hits is a valid answer for the workchain, nothing to cache
+                if ex.code != 204:
+                    raise
+
     def get_geometry(self):
         """ Getting geometry from MPDS database
         """
+        # NB mpds_client and httplib2 are only needed when the workchain actually runs
+        from httplib2 import ServerNotFoundError
+        from mpds_client import APIError
+
         # check for API key
         api_key = os.getenv('MPDS_KEY')
         if not api_key:
             return self.exit_codes.ERROR_NO_MPDS_API_KEY
-        client = MPDSDataRetrieval(api_key=api_key)
+        client = _mpds_client(api_key)
 
-        query_dict = self.inputs.mpds_query.get_dict()
-        # prepare query
-        query_dict['props'] = 'atomic structure'
-        if 'classes' in query_dict:
-            query_dict['classes'] += ', non-disordered'
-        else:
-            query_dict['classes'] = 'non-disordered'
+        query = prepare_query(self.inputs.mpds_query.get_dict())
 
         try:
-            answer = client.get_data(
-                query_dict,
-                fields={'S': [
-                    'cell_abc',
-                    'sg_n',
-                    'basis_noneq',
-                    'els_noneq'
-                ]}
-            )
+            answer = _fetch_with_retry(api_key, query, self.logger)
         except APIError as ex:
             if ex.code == 429:
-                self.logger.warning("Too many parallel MPDS requests, chilling")
-                time.sleep(random.choice([2 * 2**m for m in range(5)]))
-                return self.get_geometry()
+                self.report(f'MPDS API error: still too many requests after {MPDS_MAX_RETRIES} attempts')
             else:
                 self.report(f'MPDS API error: {str(ex)}')
                 self.logger.error(f'MPDS API error: {str(ex)}')
-                return self.exit_codes.ERROR_API_ERROR
+            return self.exit_codes.ERROR_API_ERROR
         except ServerNotFoundError as ex:
             self.report(f'MPDS API error: {str(ex)}')
             return self.exit_codes.ERROR_SERVER_NOT_FOUND
 
-        structs = [client.compile_crystal(line, flavor='ase') for line in answer]
-        structs = list(filter(None, structs))
+        # keep only the structures with minimal number of atoms while compiling
+        structs, minimal_struct = [], None
+        for line in answer:
+            ase_obj = client.compile_crystal(line, flavor='ase')
+            if not ase_obj:
+                continue
+            length = len(ase_obj)
+            if minimal_struct is None or length < minimal_struct:
+                structs, minimal_struct = [ase_obj], length
+            elif length == minimal_struct:
+                structs.append(ase_obj)
         if not structs:
             return self.exit_codes.ERROR_NO_HITS
-        minimal_struct = min([len(s) for s in structs])
 
-        # get structures with minimal number of atoms and find the one with median cell vectors
-        cells = np.array([s.get_cell().reshape(9) for s in structs if len(s) == minimal_struct])
-        median_cell = np.median(cells, axis=0)
-        median_idx = int(np.argmin(np.sum((cells - median_cell) ** 2, axis=1) ** 0.5))
-        return get_data_class('structure')(ase=structs[median_idx])
+        # find the structure with median cell vectors
+        # NB with two candidates both are equidistant from the median, so the first one is taken
+        if len(structs) <= 2:
+            median_idx = 0
+        else:
+            cells = np.empty((len(structs), 9))
+            for n, s in enumerate(structs):
+                cells[n] = s.cell.array.ravel()
+            median_cell = np.median(cells, axis=0)
+            # NB squared distances |c|^2 - 2 c.m (+ |m|^2, constant) suffice for the argmin
+            median_idx = int(np.argmin(np.einsum('ij,ij->i', cells, cells) - 2.0 * (cells @ median_cell)))
+        self._ase_structure = structs[median_idx]
+        return StructureData(ase=self._ase_structure)